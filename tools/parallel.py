@@ -3,17 +3,31 @@
 import sys
 import threading
 import queue
+import traceback
 
 
 class Printer:
     lock = None
+    # Per-thread list of buffered lines, when collecting a block
+    local = None
 
     def __init__(self):
         self.lock = None
+        self.local = threading.local()
 
     def activate(self):
         self.lock = threading.Lock()
 
+    # Buffer lines printed by this thread until endBlock
+    def startBlock(self):
+        self.local.block = []
+
+    def endBlock(self):
+        block = getattr(self.local, 'block', None)
+        self.local.block = None
+        if block:
+            self.printBlock(block)
+
     def fix(self, line):
         if len(line) == 0 or line[-1] != '\n':
             return line + '\n'
@@ -21,13 +35,24 @@ class Printer:
             return line
 
     def print(self, line):
-        nline = self.fix(line)
+        block = getattr(self.local, 'block', None)
+        if block is not None:
+            block.append(line)
+            return
+        self.printBlock([line])
+
+    # Print immediately, even when collecting a block
+    def printNow(self, line):
+        self.printBlock([line])
+
+    # Print lines together, with single acquisition of lock
+    def printBlock(self, lines):
+        text = "".join([self.fix(line) for line in lines])
         if self.lock is None:
-            sys.stdout.write(nline)
+            sys.stdout.write(text)
         else:
-            self.lock.acquire()
-            sys.stdout.write(nline)
-            self.lock.release()
+            with self.lock:
+                sys.stdout.write(text)
     
 class Scheduler:
     queue = None
@@ -49,11 +74,33 @@ class Scheduler:
     def work(self):
         while True:
             j = self.queue.get()
-            j.run()
-            self.queue.task_done()
+            try:
+                j.run()
+            except Exception:
+                # Report, but keep worker alive so that wait() can complete
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
 
     def wait(self):
         self.queue.join()
+
+# Chain of schedulers, one per stage, each with its own concurrency limit.
+# Jobs must have attribute 'stage' giving the index of their stage.
+# A job may schedule its successor in a later stage before returning.
+class Pipeline:
+    schedulers = []
+
+    def __init__(self, widths):
+        self.schedulers = [Scheduler(w) for w in widths]
+
+    def schedule(self, j):
+        self.schedulers[j.stage].schedule(j)
+
+    def wait(self):
+        # Stages only feed later stages, so waiting in order drains everything
+        for s in self.schedulers:
+            s.wait()
         
 ## Testing code
 ## 
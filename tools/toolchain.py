@@ -26,15 +26,22 @@ import getopt
 import sys
 import os.path
 import subprocess
-import datetime
+import re
 import time
+import threading
+import selectors
+import signal
+import pathlib
+import functools
+import hashlib
+import json
 
 import parallel
 
 p = parallel.Printer()
 
 def usage(name):
-    p.print("Usage: %s [-h] [-v VERB] [-t TIME] [-n NDEL] [-l NFILE] [FILE.EXT ...]" % name)
+    p.print("Usage: %s [-h] [-v VERB] [-t TIME] [-N NMAC] [-n NDEL] [-P WIDTHS] [-c] [-a] [-l NFILE] [FILE.EXT ...]" % name)
     p.print("  -h       Print this message")
 #    p.print("  -x       Exit after first error (including timeout)")
 #    p.print("  -R       Remove all generated files")
@@ -46,13 +53,18 @@ def usage(name):
 #    p.print("  -P PRE   Specify preprocessing level: (0:None, 1:+BCP, 2:+Pure lit, >=3:+BVE(P-2)");
 #    p.print("  -T TSE   Specify use of Tseitin variables (n=none, d=detect, p=promote)");
     p.print("  -t TIME  Limit time for each of the programs")
-#    p.print("  -N NMAC  Specify number of macro threads")
+    p.print("  -a       Scale time limits by input size (capped by the usual limits)")
+    p.print("  -N NMAC  Specify number of macro threads (default: cores / deletion threads)")
     p.print("  -n NDEL  Specify deletion threads")
+    p.print("  -P WIDTHS Pipeline stages with per-stage thread counts D4,GEN,CHECK,CAKE (or single count for all)")
+    p.print("  -c       Reuse D4 and GEN outputs when cache manifest shows inputs and programs unchanged")
     p.print("  -l NFILE Specify file containing root names")
     p.print("  EXT      Can be any extension for wild-card matching (e.g., cnf, nnf)")
 
-# Blocking file.  If present in directory, won't proceed.  Recheck every sleepTime seconds
+# Blocking file.  If present in directory, won't proceed.
+# Recheck with exponential backoff, from minSleepTime up to sleepTime seconds
 blockPath = "./block.txt"
+minSleepTime = 1
 sleepTime = 60
 
 # Defaults
@@ -73,50 +85,131 @@ mode = 'h'
 useLemma = True
 group = True
 
-# Threading used when set to number
+# Threading used when set to number.
+# Otherwise chosen according to number of cores when have multiple roots
 macroThreadCount = None
 deletionThreadCount = 7
+# Pipelining used when set to list of per-stage thread counts
+stageWidths = None
 
 nameFile = None
 
 #timeLimits = { "D4" : 4000, "GEN" : 1000, "FCHECK" : 1000, "LCHECK" : 1000 }
 timeLimits = { "D4" : 2000, "GEN" : 10000, "FCHECK" : 30000, "LCHECK" : 10000}
 
+# Adaptive time limits: base seconds plus seconds per MiB of program input,
+# but never more than the fixed limit
+adaptiveTime = False
+timeBases = { "D4" : 60, "GEN" : 60, "CHECK" : 60, "CAKEML" : 60 }
+timeCoefficients = { "D4" : 600, "GEN" : 120, "CHECK" : 120, "CAKEML" : 60 }
+
 clauseLimit = (1 << 31) - 1
 
 commentChar = 'c'
 
-# Pathnames
+# Size of blocks when copying program output
+chunkSize = 1 << 20
+# Size of blocks when scanning files
+blockSize = 1 << 20
+# Buffer size for log files
+logBufferSize = 1 << 20
+
+commentLinePattern = re.compile(rb'(?m)^' + re.escape(commentChar.encode()) + rb'[^\n]*\n?')
+# Leading blanks, plus rest of line if it is a comment
+cnfStripPattern = re.compile(rb'(?m)^[ \t]*(?:' + re.escape(commentChar.encode()) + rb'[^\n]*\n?)?')
+
+# Pathnames.  Programs are in directories alongside this one
+toolDirectory = os.path.dirname(os.path.abspath(__file__))
+
+@functools.lru_cache(maxsize=None)
 def genProgramPath(progName, subdirectory):
-    ppath = os.path.abspath(__file__)
-    parts = ppath.split('/')
-    if len(parts) >= 2:
-        parts[-2] = subdirectory
-        parts[-1] = progName
-    npath = "/".join(parts)
+    npath = os.path.join(os.path.dirname(toolDirectory), subdirectory, progName)
     if not os.path.exists(npath):
         raise Exception("Couldn't find program '%s'" % npath)
     return npath
 
 
-# Track files to be deleted
-cleanupFiles = []
-
-def doCleanup():
+# Delete files tracked for a root
+def doCleanup(cleanupFiles):
     if not cleanup:
         return
     for fname in cleanupFiles:
         try:
-            os.remove(fname)
+            os.unlink(fname)
+        except FileNotFoundError:
+            pass
+
+# Leading non-alphanumeric characters and trailing line endings
+trimPattern = re.compile(r'^[\W_]+|[\r\n]+$')
+
+# Cache manifest, kept in home directory.
+# Maps CNF digest to stage to (signature, output digest), where signature
+# captures the program version, its arguments, and digests of other inputs
+useCache = False
+cacheFileName = ".toolchain-cache.json"
+cacheLock = threading.Lock()
+cacheManifest = None
+
+def fileDigest(fname):
+    h = hashlib.sha256()
+    f = open(fname, 'rb')
+    while True:
+        block = f.read(blockSize)
+        if len(block) == 0:
+            break
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+# CNF files don't change during a run
+@functools.lru_cache(maxsize=None)
+def cnfDigest(cnfName):
+    return fileDigest(cnfName)
+
+def cacheSignature(cmd, inputNames = []):
+    return [os.stat(cmd[0]).st_mtime_ns] + cmd[1:] + [fileDigest(n) for n in inputNames]
+
+# Must hold cacheLock
+def loadManifest(home):
+    global cacheManifest
+    if cacheManifest is None:
+        try:
+            mfile = open(os.path.join(home, cacheFileName), 'r')
+            cacheManifest = json.load(mfile)
+            mfile.close()
         except:
-            continue
+            cacheManifest = {}
+    return cacheManifest
+
+# Can output of stage be reused?
+def cacheValid(home, stage, cnfName, signature, outName):
+    if not useCache or not os.path.exists(outName):
+        return False
+    # Hash CNF before taking lock, so that roots don't hash one at a time
+    key = cnfDigest(cnfName)
+    with cacheLock:
+        entry = loadManifest(home).get(key, {}).get(stage)
+    return entry is not None and entry[0] == signature and entry[1] == fileDigest(outName)
+
+def cacheRecord(home, stage, cnfName, signature, outName):
+    if not useCache:
+        return
+    key = cnfDigest(cnfName)
+    entry = [signature, fileDigest(outName)]
+    with cacheLock:
+        manifest = loadManifest(home)
+        manifest.setdefault(key, {})[stage] = entry
+        mname = os.path.join(home, cacheFileName)
+        try:
+            mfile = open(mname + ".tmp", 'w')
+            json.dump(manifest, mfile)
+            mfile.close()
+            os.replace(mname + ".tmp", mname)
+        except:
+            p.print("Couldn't write cache manifest '%s'" % mname)
 
 def trim(s):
-    while len(s) > 0 and not s[0].isalnum():
-        s = s[1:]
-    while len(s) > 0 and s[-1] in '\r\n':
-        s = s[:-1]
-    return s
+    return trimPattern.sub('', s)
 
 def setTimeLimit(t):
     global timeLimits
@@ -127,99 +220,182 @@ def setTimeLimit(t):
 
 def waitWhileBlocked():
     first = True
+    delay = minSleepTime
     while os.path.exists(blockPath):
         if first:
-            p.print("Waiting to unblock")
+            p.printNow("Waiting to unblock")
         first = False
-        time.sleep(sleepTime)
+        time.sleep(delay)
+        delay = min(2 * delay, sleepTime)
 
+# Count lines and bytes, excluding comment lines.
+# File is scanned in blocks, each ending at a line boundary
 def checkFile(prefix, fname, logFile):
-    f = open(fname, 'r')
+    f = open(fname, 'rb')
     bytes = 0
     lines = 0
-    for line in f:
-        if len(line) > 0 and line[0] == commentChar:
-            continue
-        bytes += len(line)
+    tail = b''
+    while True:
+        block = f.read(blockSize)
+        if len(block) == 0:
+            break
+        block = tail + block
+        split = block.rfind(b'\n') + 1
+        tail = block[split:]
+        block = commentLinePattern.sub(b'', block[:split])
+        bytes += len(block)
+        lines += block.count(b'\n')
+    tail = commentLinePattern.sub(b'', tail)
+    if len(tail) > 0:
+        bytes += len(tail)
         lines += 1
     p.print("%s: LOG: size %s %d lines %d bytes" % (prefix, fname, lines, bytes))
     logFile.write("%s: LOG: size %s %d lines %d bytes\n" % (prefix, fname, lines, bytes))
     f.close()
 
-def cleanString(s):
-    res = ""
-    for c in s:
-        if c == '\n' or c.isprintable():
-            res = res + c
-    return res
-        
+# Bytes other than newline and printable ASCII characters
+unprintableBytes = bytes(i for i in range(256) if not (i == 0x0A or 0x20 <= i < 0x7F))
+
+# Remove unprintable characters from bytes
+def cleanString(b):
+    return b.translate(None, unprintableBytes)
+
+# Copy program output to log file as it is generated, until program exits.
+# Done in calling thread, waiting on output with time limit.
+# Where supported, also wait on a process file descriptor, which becomes
+# readable when the program exits, even if a descendant holds the output open.
+# Output bytes go directly to the log's underlying binary buffer.
+# Return False if program timed out (and was killed)
+def superviseProgram(proc, logFile, timeLimit):
+    deadline = time.monotonic() + timeLimit
+    logFile.flush()
+    logBuffer = logFile.buffer
+    fd = proc.stdout.fileno()
+    sel = selectors.DefaultSelector()
+    sel.register(fd, selectors.EVENT_READ)
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+            sel.register(pidfd, selectors.EVENT_READ)
+        except OSError:
+            pidfd = None
+    ok = True
+    exited = False
+    while ok and len(sel.get_map()) > 0:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 and not exited:
+            ok = False
+            break
+        # Once program has exited, only collect output already in the pipe
+        events = sel.select(0 if exited else remaining)
+        if exited and len(events) == 0:
+            break
+        for key, mask in events:
+            if key.fd == pidfd:
+                exited = True
+                sel.unregister(pidfd)
+            else:
+                chunk = os.read(fd, chunkSize)
+                if len(chunk) > 0:
+                    logBuffer.write(cleanString(chunk))
+                else:
+                    sel.unregister(fd)
+    sel.close()
+    if ok and not exited:
+        try:
+            proc.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            ok = False
+    if not ok:
+        # Program not yet reaped, so signaling through pidfd can't hit a reused pid
+        if pidfd is not None:
+            signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+        else:
+            proc.kill()
+    proc.wait()
+    if pidfd is not None:
+        os.close(pidfd)
+    proc.stdout.close()
+    return ok
 
-def runProgram(prefix, root, commandList, logFile, extraLogName = None):
-    returnCode = 0
+def stageTimeLimit(prefix, inputNames):
     if prefix in timeLimits:
         timeLimit = timeLimits[prefix]
     else:
         timeLimit = standardTimeLimit
-    result = ""
+    if adaptiveTime and prefix in timeCoefficients:
+        mbytes = sum([os.path.getsize(n) for n in inputNames]) / (1 << 20)
+        timeLimit = min(timeLimit, int(timeBases[prefix] + timeCoefficients[prefix] * mbytes))
+    return timeLimit
+
+def runProgram(prefix, root, commandList, logFile, extraLogName = None, inputNames = []):
+    returnCode = 0
+    timeLimit = stageTimeLimit(prefix, inputNames)
+    result = []
     cstring = " ".join(commandList)
-    p.print("%s. %s: Running '%s' with time limit of %d seconds" % (root, prefix, cstring, timeLimit))
-    logFile.write("%s LOG: Running %s\n" % (prefix, cstring))
-    logFile.write("%s LOG: Time limit %d seconds\n" % (prefix, timeLimit))
-    start = datetime.datetime.now()
-    try:
-        cp = subprocess.run(commandList, capture_output = True, timeout=timeLimit, text=True)
-    except subprocess.TimeoutExpired as ex:
+    # Show which program is executing, even when other messages are being buffered
+    p.printNow("%s. %s: Running '%s' with time limit of %d seconds" % (root, prefix, cstring, timeLimit))
+    logFile.write("%s LOG: Running %s\n%s LOG: Time limit %d seconds\n" % (prefix, cstring, prefix, timeLimit))
+    start = time.monotonic()
+    # Keeping close_fds false lets subprocess launch with posix_spawn rather than fork.
+    # Files opened by Python are non-inheritable, so nothing extra leaks to the child
+    proc = subprocess.Popen(commandList, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            bufsize=0, close_fds=False)
+    if not superviseProgram(proc, logFile, timeLimit):
         # Incorporate information recorded by external logging
         if (extraLogName is not None):
             try:
-                xlog = open(extraLogName, "r")
-                for line in xlog:
-                    line = cleanString(line)
-                    logFile.write(line)
-                xlog.close()
-            except:
+                logFile.buffer.write(cleanString(pathlib.Path(extraLogName).read_bytes()))
+            except OSError:
                 pass
         p.print("%s. %s Program timed out after %d seconds" % (root, prefix, timeLimit))
-        result += "%s ERROR: Timeout after %d seconds\n" % (prefix, timeLimit)
-        delta = datetime.datetime.now() - start
-        seconds = delta.seconds + 1e-6 * delta.microseconds
-        result += "%s LOG: Elapsed time = %.3f seconds\n" % (prefix, seconds)
-        result += "%s OUTCOME: Timeout\n" % (prefix)
-        logFile.write(result)
+        result.append("%s ERROR: Timeout after %d seconds\n" % (prefix, timeLimit))
+        seconds = time.monotonic() - start
+        result.append("%s LOG: Elapsed time = %.3f seconds\n" % (prefix, seconds))
+        result.append("%s OUTCOME: Timeout\n" % (prefix))
+        logFile.write(''.join(result))
         return (False, 1)
     ok = True
-    returnCode = cp.returncode
+    returnCode = proc.returncode
     if returnCode != 0:
-        result += "%s ERROR: Return code = %d\n" % (prefix, cp.returncode)
+        result.append("%s ERROR: Return code = %d\n" % (prefix, returnCode))
         ok = False
     outcome = "normal" if ok else "failed"
-    delta = datetime.datetime.now() - start
-    seconds = delta.seconds + 1e-6 * delta.microseconds
-    result += "%s LOG: Elapsed time = %.3f seconds\n" % (prefix, seconds)
-    result += "%s OUTCOME: %s\n" % (prefix, outcome)
+    seconds = time.monotonic() - start
+    result.append("%s LOG: Elapsed time = %.3f seconds\n" % (prefix, seconds))
+    result.append("%s OUTCOME: %s\n" % (prefix, outcome))
     p.print("%s. %s: OUTCOME: %s" % (root, prefix, outcome))
     p.print("%s. %s: Elapsed time: %.3f seconds" % (root, prefix, seconds))
-    logFile.write(cleanString(cp.stdout))
-    logFile.write(result)
+    logFile.write(''.join(result))
     return (ok, returnCode)
 
-def stripComments(inCnfName, outCnfName):
+# Copy CNF file, removing leading blanks and comment lines.
+# File is processed in blocks, each ending at a line boundary.
+# Not applied to toolchain inputs: D4 and the generator read the original CNF,
+# whose comment lines carry the projection ("c p show") declarations
+def stripComments(inCnfName, outCnfName, logFile):
     try:
-        infile = open(inCnfName, "r")
+        infile = open(inCnfName, "rb")
     except:
         logFile.write("Couldn't open input CNF file '%s'\n" % inCnfName)
         return False
     try:
-        outfile = open(outCnfName, "w")
+        outfile = open(outCnfName, "wb")
     except:
         logFile.write("Couldn't open output CNF file '%s'\n" % outCnfName)
-        close(infile)
+        infile.close()
         return False
-    for line in infile:
-        while len(line) > 0 and line[0] in " \t":
-            line = line[1:]
-        if len(line) > 0 and line[0] != 'c':
-            outfile.write(line)
+    tail = b''
+    while True:
+        block = infile.read(blockSize)
+        if len(block) == 0:
+            break
+        block = tail + block
+        split = block.rfind(b'\n') + 1
+        tail = block[split:]
+        outfile.write(cnfStripPattern.sub(b'', block[:split]))
+    outfile.write(cnfStripPattern.sub(b'', tail))
     infile.close()
     outfile.close()
     return True
@@ -241,7 +417,7 @@ def cpogNamer(root, home):
     return cpogName
 
 # Only run D4 if don't yet have .nnf file
-def runD4(root, home, logFile, force):
+def runD4(root, home, logFile, force, cleanupFiles):
     cnfName = cnfNamer(root, home)
     nnfName = nnfNamer(root, home)
     if not force and os.path.exists(nnfName):
@@ -251,10 +427,19 @@ def runD4(root, home, logFile, force):
         cmd += ['--skolem', 'on']
     cmd += ['--dump-ddnnf',  nnfName]
     prefix = "D4"
-    ok = runProgram(prefix, root, cmd, logFile)[0]
+    signature = cacheSignature(cmd) if useCache else None
+    if cacheValid(home, prefix, cnfName, signature, nnfName):
+        p.print("%s. %s: Reusing cached %s" % (root, prefix, nnfName))
+        logFile.write("%s LOG: Reusing cached %s\n" % (prefix, nnfName))
+        checkFile(root + ". D4 NNF", nnfName, logFile)
+        return True
+    ok = runProgram(prefix, root, cmd, logFile, inputNames = [cnfName])[0]
     if ok:
         checkFile(root + ". D4 NNF", nnfName, logFile)
-    cleanupFiles.append(nnfName)
+        cacheRecord(home, prefix, cnfName, signature, nnfName)
+    # Keep NNF file when it may be reused
+    if force and not useCache:
+        cleanupFiles.add(nnfName)
     return ok
 
 def runGen(root, home, logFile, force):
@@ -265,7 +450,7 @@ def runGen(root, home, logFile, force):
     elif mode == 's':
         monolithic_threshold = 1
         tree_ratio_threshold = 0
-    extraLogName = "generate.log"
+    extraLogName = root + ".generate.log"
     cnfName = cnfNamer(root, home)
     nnfName = nnfNamer(root, home)
     cpogName = cpogNamer(root, home)
@@ -277,16 +462,24 @@ def runGen(root, home, logFile, force):
         cmd += ['-a', 'f']
     cmd += ['-m', str(monolithic_threshold), '-r', str(tree_ratio_threshold)]
     cmd += ["-C", str(clauseLimit), "-L", extraLogName, cnfName, nnfName, cpogName]
-    ok, returnCode = runProgram("GEN", root, cmd, logFile, extraLogName = extraLogName)
+    prefix = "GEN"
+    signature = cacheSignature(cmd, [nnfName]) if useCache else None
+    if cacheValid(home, prefix, cnfName, signature, cpogName):
+        p.print("%s. %s: Reusing cached %s" % (root, prefix, cpogName))
+        logFile.write("%s LOG: Reusing cached %s\n" % (prefix, cpogName))
+        checkFile(root + ". GEN", cpogName, logFile)
+        return True
+    ok, returnCode = runProgram(prefix, root, cmd, logFile, extraLogName = extraLogName, inputNames = [cnfName, nnfName])
     if ok:
         checkFile(root + ". GEN", cpogName, logFile)
-#    cleanupFiles.append(cpogName)
+        cacheRecord(home, prefix, cnfName, signature, cpogName)
+#    cleanupFiles.add(cpogName)
     return ok
 
 def runCheck(root, home, logFile):
     cnfName = cnfNamer(root, home)
     cpogName = cpogNamer(root, home)
-    extraLogName = "check.log"
+    extraLogName = root + ".check.log"
     cmd = [genProgramPath("cpog-check", "cpog/checker")]
     cmd += ["-v", str(verbLevel)]
     cmd += ["-L", extraLogName]
@@ -295,7 +488,7 @@ def runCheck(root, home, logFile):
     if forwardOnly:
         cmd += ['-D']
     cmd += [cnfName, cpogName]
-    ok =  runProgram("CHECK", root, cmd, logFile, extraLogName = extraLogName)[0]
+    ok =  runProgram("CHECK", root, cmd, logFile, extraLogName = extraLogName, inputNames = [cnfName, cpogName])[0]
     return ok
 
 def runCake(root, home, logFile):
@@ -303,47 +496,90 @@ def runCake(root, home, logFile):
     cpogName = cpogNamer(root, home)
     cmd = [genProgramPath("cake_scpog", "cake_scpog")]
     cmd += [cnfName, cpogName]
-    ok = runProgram("CAKEML", root, cmd, logFile)
+    ok = runProgram("CAKEML", root, cmd, logFile, inputNames = [cnfName, cpogName])[0]
     return ok
 
 
-def runSequence(home, root, force):
-    waitWhileBlocked()
-    result = ""
-    prefix = "OVERALL"
-    start = datetime.datetime.now()
-    extension = "log"
-    if forwardOnly:
-        extension = "forward_" + extension
-    prefix = "mono_" if mode == 'm' else "structured_" if mode == 's' else ""
-    extension = prefix + extension
-    logName = root + "." + extension
-    if not force and os.path.exists(logName):
-        p.print("Already have file %s.  Skipping benchmark" % logName)
+# State for processing a single root, shared by the stages of the toolchain
+class RootRun:
+    home = None
+    root = None
+    force = None
+    prefix = None
+    logName = None
+    logFile = None
+    # Guards logFile when stages run in different threads
+    lock = None
+    start = None
+    ok = True
+    # Files to be deleted once root is done
+    cleanupFiles = None
+
+    def __init__(self, home, root, force):
+        self.home = home
+        self.root = root
+        self.force = force
+        self.lock = threading.Lock()
+        self.cleanupFiles = set()
+
+    # Open log file.  Return False if stages should not be run,
+    # with self.ok indicating whether this is an error
+    def begin(self):
+        waitWhileBlocked()
+        self.prefix = "OVERALL"
+        self.start = time.monotonic()
+        extension = "log"
+        if forwardOnly:
+            extension = "forward_" + extension
+        self.prefix = "mono_" if mode == 'm' else "structured_" if mode == 's' else ""
+        extension = self.prefix + extension
+        self.logName = self.root + "." + extension
+        if not self.force and os.path.exists(self.logName):
+            p.print("Already have file %s.  Skipping benchmark" % self.logName)
+            self.ok = True
+            return False
+        try:
+            self.logFile = open(self.logName, 'w', buffering=logBufferSize)
+        except:
+            p.print("%s. %s ERROR:Couldn't open file '%s'" % (self.root, self.prefix, self.logName))
+            self.ok = False
+            return False
         return True
+
+    # Record exception raised by a stage, such as a missing program
+    def error(self, ex):
+        p.print("%s. %s ERROR: %s" % (self.root, self.prefix, str(ex)))
+        self.logFile.write("%s ERROR: %s\n" % (self.prefix, str(ex)))
+
+    def finish(self, ok):
+        self.ok = ok
+        result = []
+        prefix = self.prefix
+        seconds = time.monotonic() - self.start
+        result.append("%s LOG: Elapsed time = %.3f seconds\n" % (prefix, seconds))
+        outcome = "normal" if ok else "failed"
+        result.append("%s OUTCOME: %s\n" % (prefix, outcome))
+        p.print("%s. %s OUTCOME: %s" % (self.root, prefix, outcome))
+        p.print("%s. %s Elapsed time: %.3f seconds" % (self.root, prefix, seconds))
+        p.print("%s. %s Logfile at %s" % (self.root, prefix, self.logName))
+        self.logFile.write(''.join(result))
+        self.logFile.close()
+        doCleanup(self.cleanupFiles)
+        return ok
+
+def runSequence(home, root, force):
+    r = RootRun(home, root, force)
+    if not r.begin():
+        return r.ok
     try:
-        logFile = open(logName, 'w')
-    except:
-        p.print("%s. %s ERROR:Couldn't open file '%s'" % (root, prefix, logName))
-        return False
-    ok = True
-    done = False
-    ok = runD4(root, home, logFile, force)
-    ok = ok and runGen(root, home, logFile, force)
-    ok = ok and runCheck(root, home, logFile)
-    ok = ok and runCake(root, home, logFile)
-    delta = datetime.datetime.now() - start
-    seconds = delta.seconds + 1e-6 * delta.microseconds
-    result += "%s LOG: Elapsed time = %.3f seconds\n" % (prefix, seconds)
-    outcome = "normal" if ok else "failed"
-    result += "%s OUTCOME: %s\n" % (prefix, outcome)
-    p.print("%s. %s OUTCOME: %s" % (root, prefix, outcome))
-    p.print("%s. %s Elapsed time: %.3f seconds" % (root, prefix, seconds))
-    p.print("%s. %s Logfile at %s" % (root, prefix, logName))
-    logFile.write(result)
-    logFile.close()
-    doCleanup()
-    return ok
+        ok = runD4(root, home, r.logFile, force, r.cleanupFiles)
+        ok = ok and runGen(root, home, r.logFile, force)
+        ok = ok and runCheck(root, home, r.logFile)
+        ok = ok and runCake(root, home, r.logFile)
+    except Exception as ex:
+        r.error(ex)
+        ok = False
+    return r.finish(ok)
 
 def stripSuffix(fname):
     fields = fname.split(".")
@@ -361,21 +597,122 @@ class Job:
         self.root = root
         self.force = force
 
+    # Messages for root are printed together when it completes,
+    # except for ones that show current activity
     def run(self):
-        runSequence(self.home, self.root, self.force)
+        p.startBlock()
+        try:
+            runSequence(self.home, self.root, self.force)
+        finally:
+            p.endBlock()
+
+
+# Pipelined execution: each stage is a separate job.
+# On success, a job schedules the job for the next stage of its root
+class StageJob:
+    stage = None
+    rootRun = None
+    pipeline = None
 
+    def __init__(self, rootRun, pipeline):
+        self.rootRun = rootRun
+        self.pipeline = pipeline
+
+    def execute(self):
+        return False
+
+    def successor(self):
+        return None
+
+    # Run stage.  Return job for next stage, if any
+    def process(self):
+        r = self.rootRun
+        with r.lock:
+            try:
+                ok = self.execute()
+            except Exception as ex:
+                r.error(ex)
+                ok = False
+            nextJob = self.successor() if ok else None
+            if nextJob is None:
+                r.finish(ok)
+        return nextJob
+
+    # Messages for stage are printed together before next stage is scheduled
+    def run(self):
+        p.startBlock()
+        try:
+            nextJob = self.process()
+        finally:
+            p.endBlock()
+        if nextJob is not None:
+            self.pipeline.schedule(nextJob)
+
+class D4Job(StageJob):
+    stage = 0
+
+    def execute(self):
+        r = self.rootRun
+        return runD4(r.root, r.home, r.logFile, r.force, r.cleanupFiles)
+
+    def successor(self):
+        return GenJob(self.rootRun, self.pipeline)
+
+    def process(self):
+        with self.rootRun.lock:
+            proceed = self.rootRun.begin()
+        return StageJob.process(self) if proceed else None
+
+class GenJob(StageJob):
+    stage = 1
+
+    def execute(self):
+        r = self.rootRun
+        return runGen(r.root, r.home, r.logFile, r.force)
+
+    def successor(self):
+        return CheckJob(self.rootRun, self.pipeline)
+
+class CheckJob(StageJob):
+    stage = 2
+
+    def execute(self):
+        r = self.rootRun
+        return runCheck(r.root, r.home, r.logFile)
+
+    def successor(self):
+        return CakeJob(self.rootRun, self.pipeline)
+
+class CakeJob(StageJob):
+    stage = 3
+
+    def execute(self):
+        r = self.rootRun
+        return runCake(r.root, r.home, r.logFile)
+
+def runPipeline(home, roots, force):
+    pl = parallel.Pipeline(stageWidths)
+    p.activate()
+    for r in roots:
+        pl.schedule(D4Job(RootRun(home, r, force), pl))
+    pl.wait()
 
 def runBatch(home, fileList, force):
     roots = [stripSuffix(f) for f in fileList]
     roots = [r for r in roots if r is not None]
     p.print("Running on roots %s" % roots)
-    if macroThreadCount is None:
+    threadCount = macroThreadCount
+    if threadCount is None and len(roots) > 1 and not exitWhenError:
+        threadCount = (os.cpu_count() or 1) // max(1, deletionThreadCount)
+    if stageWidths is not None:
+        runPipeline(home, roots, force)
+    elif threadCount is None or (macroThreadCount is None and threadCount <= 1):
         for r in roots:
             if not runSequence(home, r, force) and exitWhenError:
                 p.print("Error encountered.  Exiting")
                 return
     else:
-        s = parallel.Scheduler(macroThreadCount)
+        s = parallel.Scheduler(threadCount)
         p.activate()
         for r in roots:
             j = Job(home, r, force)
@@ -384,22 +721,40 @@ def runBatch(home, fileList, force):
 
 def run(name, args):
     global verbLevel, nameFile
-    global deletionThreadCount
+    global deletionThreadCount, stageWidths, macroThreadCount, useCache, adaptiveTime
     home = "."
     force = True
-    optList, args = getopt.getopt(args, "hv:t:l:n:")
+    optList, args = getopt.getopt(args, "hv:t:l:N:n:P:ca")
     for (opt, val) in optList:
         if opt == '-h':
             usage(name)
             return
         if opt == '-v':
             verbLevel = int(val)
+        elif opt == '-N':
+            macroThreadCount = int(val)
         elif opt == '-n':
             deletionThreadCount = int(val)
         elif opt == '-t':
             setTimeLimit(int(val))
+        elif opt == '-c':
+            useCache = True
+        elif opt == '-a':
+            adaptiveTime = True
         elif opt == '-l':
             nameFile = val
+        elif opt == '-P':
+            try:
+                widths = [int(w) for w in val.split(',')]
+            except ValueError:
+                widths = []
+            if len(widths) == 1:
+                widths = widths * 4
+            if len(widths) != 4 or min(widths) < 1:
+                p.print("Invalid stage widths '%s'" % val)
+                usage(name)
+                return
+            stageWidths = widths
         else:
             p.print("Unknown option '%s'" % opt)
             usage(name)
@@ -407,15 +762,12 @@ def run(name, args):
     fileList = args
     if nameFile is not None:
         try:
-            nfile = open(nameFile, 'r')
+            text = pathlib.Path(nameFile).read_text()
         except:
             p.print("Couldn't open name file '%s'" % nameFile)
             usage(name)
             return
-        for line in nfile:
-            fname = trim(line)
-            fileList.append(fname)
-        nfile.close()
+        fileList += [trim(line) for line in text.splitlines() if line.strip()]
             
     runBatch(home, fileList, force)
 